@@ -5,35 +5,70 @@ Created on Mon Aug 19 16:52:24 2024
 @author: romain.coulon
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import numpy as np
-import scipy.ndimage as sp
-from scipy.signal import butter, filtfilt
-from scipy.stats import truncnorm
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import butter, fftconvolve, lfilter, oaconvolve, sosfilt, sosfiltfilt, tf2sos, windows
+from scipy.special import ndtr, ndtri
+
+try:
+    from numba import njit
+    _HAS_NUMBA = True
+except ImportError:
+    # numba is optional: fall back to a no-op decorator
+    _HAS_NUMBA = False
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        def decorator(func):
+            return func
+        return decorator
 
-def low_pass_filter(v, timeStep, bandwidth):
+@lru_cache(maxsize=32)
+def _gaussian_kernel(sigma):
+    # normalized Gaussian FIR with the same support as gaussian_filter1d (truncate=4)
+    radius = int(4.0*sigma + 0.5)
+    kern = windows.gaussian(2*radius + 1, sigma)
+    return kern / kern.sum()
+
+@lru_cache(maxsize=32)
+def _butter_low_pass_sos(timeStep, bandwidth):
     # Calculate the Nyquist frequency
     nyquist = 0.5 / timeStep
-    
+
     # Normalize the bandwidth with respect to the Nyquist frequency
     normal_cutoff = bandwidth / nyquist
-    
-    # Create a Butterworth low-pass filter
-    b, a = butter(N=4, Wn=normal_cutoff, btype='low', analog=False)
-    
-    # Apply the filter to the voltage signal
-    v_filtered = filtfilt(b, a, v)
-    
+
+    # Create a Butterworth low-pass filter (second-order sections for numerical stability)
+    return butter(N=4, Wn=normal_cutoff, btype='low', analog=False, output='sos')
+
+def low_pass_filter(v, timeStep, bandwidth, phase='causal'):
+    # The filter design is cached: repeated frames with the same
+    # timeStep/bandwidth reuse the same coefficients
+    sos = _butter_low_pass_sos(timeStep, bandwidth)
+
+    # Apply the filter to the voltage signal: a real anti-aliasing stage is
+    # causal (single forward pass); 'linear' keeps the zero-phase double pass
+    if phase == 'causal':
+        v_filtered = sosfilt(sos, v)
+    else:
+        v_filtered = sosfiltfilt(sos, v)
+
     return v_filtered
 
-def add_quantization_noise(v, coding_resolution_bits, full_scale_range):
+def add_quantization_noise(v, coding_resolution_bits, full_scale_range, rng=None):
+    rng = np.random.default_rng(rng)
+
     # Calculate the number of quantization levels
     num_levels = 2**coding_resolution_bits
-    
+
     # Determine the quantization step size
     quantization_step_size = full_scale_range / num_levels
-    
+
     # Generate noise uniformly distributed between -0.5 and 0.5 of the quantization step size
-    noise = np.random.uniform(-0.5, 0.5, size=len(v)) * quantization_step_size
+    noise = rng.uniform(-0.5, 0.5, size=len(v)) * quantization_step_size
     
     # Add the noise to the original signal
     v_noisy = v + noise
@@ -44,6 +79,30 @@ def saturate(v, full_scale_range):
     v_clipped = np.clip(v, -full_scale_range / 2, full_scale_range / 2)
     return v_clipped
 
+def digitize(v, coding_resolution_bits, full_scale_range, rng=None):
+    # Quantization noise and ADC saturation fused in a single pass over v:
+    # equivalent to add_quantization_noise() followed by saturate() on the
+    # +/- full_scale_range dynamic range, without the intermediate array
+    rng = np.random.default_rng(rng)
+
+    # Determine the quantization step size
+    quantization_step_size = full_scale_range / 2**coding_resolution_bits
+
+    v_out = v + (rng.random(len(v)) - 0.5) * quantization_step_size
+    np.clip(v_out, -full_scale_range, full_scale_range, out=v_out)
+    return v_out
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _rc_filter_loop(v, alpha):
+    one_minus_alpha = 1 - alpha
+    v_out = np.empty_like(v)
+    v_out[0] = v[0]  # Initial condition
+
+    for i in range(1, len(v)):
+        v_out[i] = alpha * v[i] + one_minus_alpha * v_out[i-1]
+
+    return v_out
+
 def rc_filter(v, tau, dt):
     """
     Apply an RC filter to the voltage signal v.
@@ -56,12 +115,26 @@ def rc_filter(v, tau, dt):
     Returns:
     numpy array: Filtered voltage signal.
     """
+    v = np.asarray(v)
+    if v.dtype not in (np.float32, np.float64):
+        v = v.astype(np.float64)
     alpha = dt / (tau + dt)
-    v_out = np.zeros_like(v)
+    if _HAS_NUMBA:
+        return _rc_filter_loop(v, alpha)
+    # same one-pole recursion through scipy's C implementation
+    b = np.array([alpha], dtype=v.dtype)
+    a = np.array([1.0, -(1 - alpha)], dtype=v.dtype)
+    zi = np.array([(1 - alpha) * v[0]], dtype=v.dtype) # so that v_out[0] = v[0]
+    v_out, _ = lfilter(b, a, v, zi=zi)
+    return v_out
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _cr_filter_loop(v, alpha):
+    v_out = np.empty_like(v)
     v_out[0] = v[0]  # Initial condition
 
     for i in range(1, len(v)):
-        v_out[i] = alpha * v[i] + (1 - alpha) * v_out[i-1]
+        v_out[i] = alpha * (v_out[i-1] + v[i] - v[i-1])
 
     return v_out
 
@@ -77,14 +150,17 @@ def cr_filter(v, tau, dt):
     Returns:
     numpy array: Filtered voltage signal.
     """
+    v = np.asarray(v)
+    if v.dtype not in (np.float32, np.float64):
+        v = v.astype(np.float64)
     alpha = tau / (tau + dt)
-    v_out = np.zeros_like(v)
-    v_out[0] = v[0]  # Initial condition
-
-    for i in range(1, len(v)):
-        v_out[i] = alpha * (v_out[i-1] + v[i] - v[i-1])
-        # v_out[i] = (v[i] - v[i-1])
-
+    if _HAS_NUMBA:
+        return _cr_filter_loop(v, alpha)
+    # same one-pole recursion through scipy's C implementation
+    b = np.array([alpha, -alpha], dtype=v.dtype)
+    a = np.array([1.0, -alpha], dtype=v.dtype)
+    zi = np.array([(1 - alpha) * v[0]], dtype=v.dtype) # so that v_out[0] = v[0]
+    v_out, _ = lfilter(b, a, v, zi=zi)
     return v_out
 
 def scintiPulses(Y, tN=1e-4, fS=500e6, tau1 = 100e-9, tau2 = 2000e-9, p_delayed = 0,
@@ -96,7 +172,8 @@ def scintiPulses(Y, tN=1e-4, fS=500e6, tau1 = 100e-9, tau2 = 2000e-9, p_delayed
                                  pream = False, G1 = 1, tauRC = 10e-6,
                                  ampli = False, G2 = 1, tauCR = 2e-6, nCR=1,                                 
                                  digitization=False, fc = 2e8, R=14, Vs=2,
-                                 returnPulse = False):
+                                 returnPulse = False, rng = None,
+                                 return_intermediates = True, dtype = np.float64):
     """
     This function simulate a signal from a scintillation detector.
 
@@ -173,6 +250,12 @@ def scintiPulses(Y, tN=1e-4, fS=500e6, tau1 = 100e-9, tau2 = 2000e-9, p_delayed
     
     returnPulse : boolean, optional
         to return a single pulse for observation. The default is False.
+    rng : numpy.random.Generator, seed or SeedSequence, optional
+        source of randomness passed to numpy.random.default_rng(). The default is None (fresh PCG64 stream).
+    return_intermediates : boolean, optional
+        to return every intermediate stage v0..v8. If False, only (t, v8, y0, y1) is returned. The default is True.
+    dtype : numpy dtype, optional
+        floating-point type of the signal arrays. np.float32 halves the memory traffic and is sufficient for a 14-bit digitizer. The default is np.float64.
 
     Returns
     -------
@@ -203,19 +286,24 @@ def scintiPulses(Y, tN=1e-4, fS=500e6, tau1 = 100e-9, tau2 = 2000e-9, p_delayed
 
     """
 
-    arrival_times = [0]
-    while arrival_times[-1]<tN:
-        arrival_times.append(arrival_times[-1] + np.random.exponential(scale=1/lambda_, size=1))
-    arrival_times=arrival_times[1:-1]
-    
+    rng = np.random.default_rng(rng)
+
+    # homogeneous Poisson process: batched exponential waiting times + cumsum
+    M = int(1.5*tN*lambda_) + 64
+    arrival_times = np.cumsum(rng.exponential(scale=1/lambda_, size=M))
+    while arrival_times[-1] < tN:
+        extra = rng.exponential(scale=1/lambda_, size=M)
+        arrival_times = np.concatenate((arrival_times, arrival_times[-1] + np.cumsum(extra)))
+    arrival_times = arrival_times[arrival_times < tN]
+
     N = len(arrival_times)
     if N>len(Y):
         print(f"boostrap {100*len(Y)/N} %")
-        Y = np.random.choice(Y, N, replace=True) # boostraping
+        Y = rng.choice(Y, N, replace=True) # boostraping
     
     timeStep = 1/fS
     
-    t = np.arange(0,tN,timeStep)
+    t = np.arange(0,tN,timeStep,dtype=dtype)
     n = len(t)
     
     
@@ -224,92 +312,152 @@ def scintiPulses(Y, tN=1e-4, fS=500e6, tau1 = 100e-9, tau2 = 2000e-9, p_delayed
     Nphe = Y*L # nb de photoelectron / decay
     
     # Illumination function (v0)
-    v0=np.zeros(n)
-    y0 =np.zeros(n)
-    y1 = np.zeros(n)
-    for i, ti in enumerate(arrival_times):
-        IllumFCT0 = (1-p_delayed)*(Nphe[i]/tau1) * np.exp(-t/tau1)+p_delayed*(Nphe[i]/tau2) * np.exp(-t/tau2) # Exponential law x the nb of PHE
-        IllumFCT0 *= timeStep
-        # cumCharge = np.cumsum(IllumFCT0)
-        flag0 = int(ti[0]/timeStep)
-        y0[flag0] += Y[i]
-        if Nphe[i] > 0:
-            if returnPulse:
-                v0=np.concatenate((np.zeros(len(IllumFCT0)),IllumFCT0))
-                t = np.arange(-tN,tN,timeStep)
-                n = len(t)
-                break
-            else:
-                flag = int(ti[0]/timeStep)
-                v0 += np.concatenate((np.zeros(flag),IllumFCT0[:n-flag]))
-                y1[flag] += Nphe[i]
-                
-    
-    # Quantum illumination function
-    # v=voltageBaseline*np.ones(n)
-    v1=np.zeros(n)
-    for i, l in enumerate(v0):
-        # ne = int(l) + np.random.binomial(n=1, p=l-int(l))
-        ne = np.random.poisson(l)
-        if ne>0:
-            # vi = np.random.normal(se_pulseCharge,pulseSpread,ne)
-            # v1[i]+=sum(vi)
-            v1[i]+=ne
-            # print("here",i, l, v1[i])
-        
+    v0=np.zeros(n,dtype=dtype)
+    y0 =np.zeros(n,dtype=dtype)
+    y1 = np.zeros(n,dtype=dtype)
+    flags = (arrival_times/timeStep).astype(np.int64)
+    np.add.at(y0, flags, Y[:N])
+    # all pulses share the same exponential shape: compute the unit kernel once
+    kern = ((1-p_delayed)/tau1 * np.exp(-t/tau1) + p_delayed/tau2 * np.exp(-t/tau2))*timeStep
+    if returnPulse:
+        hit = np.flatnonzero(Nphe[:N] > 0)
+        if hit.size > 0:
+            i = hit[0]
+            v0 = np.zeros(2*n,dtype=dtype)
+            v0[n:] = Nphe[i]*kern # pulse centred in the doubled frame, no concatenate copy
+            t = np.arange(-tN,tN,timeStep,dtype=dtype)
+            n = len(t)
+    else:
+        np.add.at(y1, flags, Nphe[:N])
+        imp = np.zeros(n,dtype=dtype)
+        np.add.at(imp, flags, Nphe[:N])
+        v0 = fftconvolve(imp, kern, mode='full')[:n]
+        np.clip(v0, 0, None, out=v0) # FFT round-off can leave tiny negative values
+
+
+    # Quantum illumination function: one vectorized Poisson draw over the whole frame
+    v1 = rng.poisson(v0).astype(dtype)
+
+
     # After-pulses
-    v2=v1.copy()
+    v2=v1
     if afterPulses:
-        for i, l in enumerate(v1):
-            # ne = int(l) + np.random.binomial(n=1, p=l-int(l))
-            if l>0:
-                a, b = (0 -tauA) / sigmaA, ((n-i)*timeStep - tauA) / sigmaA
-                delta_A = truncnorm.rvs(a, b, loc=tauA, scale=sigmaA)
-                t_iAP = int(delta_A/timeStep)
-                if i+t_iAP<n :
-                    # v2[i+t_iAP]+=np.random.poisson(pA*l)
-                    v2[i+t_iAP]+=np.random.binomial(l, pA)
+        v2=v1.copy()
+        nz = np.flatnonzero(v1) # only photoelectron cells can seed after-pulses
+        if nz.size > 0:
+            counts = v1[nz].astype(np.int64)
+            a, b = (0 -tauA) / sigmaA, ((n-nz)*timeStep - tauA) / sigmaA
+            # truncated normal sampled by inverse CDF: a few ufunc calls
+            # instead of the full truncnorm.rvs distribution machinery
+            Fa, Fb = ndtr(a), ndtr(b)
+            # keep the CDF argument in the open interval: ndtr underflows to
+            # exactly 0/1 for standardized bounds beyond ~38 sigma and ndtri
+            # would return +/-inf
+            u = np.clip(Fa + rng.random(nz.size)*(Fb - Fa),
+                        np.finfo(float).tiny, 1 - np.finfo(float).eps)
+            delta_A = tauA + sigmaA*ndtri(u)
+            np.clip(delta_A, 0, (n-nz)*timeStep, out=delta_A) # enforce the truncation bounds
+            targets = nz + (delta_A/timeStep).astype(np.int64)
+            nAP = rng.binomial(counts, pA)
+            inframe = (targets >= 0) & (targets < n)
+            np.add.at(v2, targets[inframe], nAP[inframe])
     
     # Thermoionic noise
-    v3=v2.copy()
+    v3=v2
     if darkNoise:
-        arrival_times2 = [0]
-        while arrival_times2[-1]<tN:
-            arrival_times2.append(arrival_times2[-1] + np.random.exponential(scale=1/fD, size=1))
-        arrival_times2=arrival_times2[1:-1]
-        for i, ti in enumerate(arrival_times2):
-            flag = int(ti[0]/timeStep)
-            # vi = 1np.random.normal(se_pulseCharge,pulseSpread,1)
-            v3[flag]+=1#vi[0]
-            # print("noise",flag, v3[flag]-v2[flag])
+        v3=v2.copy()
+        M2 = int(1.5*tN*fD) + 64
+        arrival_times2 = np.cumsum(rng.exponential(scale=1/fD, size=M2))
+        while arrival_times2[-1] < tN:
+            extra = rng.exponential(scale=1/fD, size=M2)
+            arrival_times2 = np.concatenate((arrival_times2, arrival_times2[-1] + np.cumsum(extra)))
+        arrival_times2 = arrival_times2[arrival_times2 < tN]
+        flags2 = (arrival_times2/timeStep).astype(np.int64)
+        flags2 = flags2[flags2 < n]
+        np.add.at(v3, flags2, 1.0) # one thermoionic electron per arrival
     
-    # Voltage conversion
-    kC = np.random.normal(1,sigma_C1,1)
-    v4 = -I*(kC/C1)*sp.gaussian_filter1d(v3,tauS/timeStep)
+    # Voltage conversion: single-electron response of the photodetector
+    kC = rng.normal(1,sigma_C1)
+    sigmaS = tauS/timeStep
+    if sigmaS < 3:
+        # few-tap response (common DAQ case tauS ~ timeStep): a cached
+        # Gaussian FIR avoids the generic ndimage correlate overhead
+        kernS = _gaussian_kernel(sigmaS).astype(dtype, copy=False)
+        v4 = -I*(kC/C1)*oaconvolve(v3, kernS, mode='same')
+    else:
+        v4 = -I*(kC/C1)*gaussian_filter1d(v3, sigmaS)
     
     # thermal noise
-    v5=v4.copy()
-    if electronicNoise: v5+=sigmaRMS*np.random.normal(0,1,n)
-    
+    v5=v4
+    if electronicNoise: v5 = v4 + sigmaRMS*rng.standard_normal(n, dtype=dtype)
+
     # preamplifier
-    v6=v5.copy()
+    v6=v5
     if pream: v6 = G1*rc_filter(v5, tauRC, timeStep)
-    
+
     # amplifier
-    v7=v6.copy()
+    v7=v6
     if ampli:
-        for i in range(nCR):
+        if nCR == 1:
             v7 = G2*cr_filter(v6, tauCR, timeStep)
-       
+        else:
+            # fuse the nCR cascaded CR stages into one order-nCR IIR pass
+            alpha = tauCR / (tauCR + timeStep)
+            b1, a1 = np.array([alpha, -alpha]), np.array([1.0, -alpha])
+            bn, an = b1, a1
+            for i in range(nCR-1):
+                bn = np.convolve(bn, b1)
+                an = np.convolve(an, a1)
+            v7 = G2*sosfilt(tf2sos(bn, an), v6).astype(dtype, copy=False)
+
     # digitizer
-    v8=v7.copy()
+    v8=v7
     if digitization:
         v8 = low_pass_filter(v7, timeStep, fc)
-        v8 = add_quantization_noise(v8, R, Vs)
-        v8 = saturate(v8, Vs*2)
+        v8 = digitize(v8, R, Vs, rng=rng).astype(dtype, copy=False)
+    if not return_intermediates:
+        return t, v8, y0, y1
     return t, v0, v1, v2, v3, v4, v5, v6, v7, v8, y0, y1
 
 
+def scintiPulses_batch(Y_list, n_jobs=None, rng=None, **kwargs):
+    """
+    Simulate several independent signal frames in parallel threads.
+
+    Each frame draws from its own child stream spawned from a common
+    SeedSequence, so the frames are statistically independent and the whole
+    batch is reproducible from a single seed. The heavy stages (scipy IIR
+    filters, jitted RC/CR loops) release the GIL, so the threads scale with
+    the available cores.
+
+    Parameters
+    ----------
+    Y_list : list
+        one vector of deposited energies in keV per frame.
+    n_jobs : int, optional
+        number of worker threads. The default is None (chosen by the executor).
+    rng : seed or numpy.random.SeedSequence, optional
+        master seed from which one child stream is spawned per frame. The default is None.
+    **kwargs
+        forwarded to scintiPulses().
+
+    Returns
+    -------
+    list
+        the scintiPulses() output tuple of each frame, in order.
+
+    """
+    if isinstance(rng, np.random.SeedSequence):
+        ss = rng
+    else:
+        ss = np.random.SeedSequence(rng)
+    children = ss.spawn(len(Y_list))
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(scintiPulses, Y, rng=np.random.default_rng(child), **kwargs)
+                   for Y, child in zip(Y_list, children)]
+        return [future.result() for future in futures]
+
+
 
 # import tdcrpy as td
 # import matplotlib.pyplot as plt